@@ -4,33 +4,300 @@ Module done for the Hackaviz 2025 event.
 """
 
 from datetime import datetime
-from os import system
-from os.path import exists, join
+from os.path import join
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import pyarrow.parquet as pq
 import streamlit as st
 
-if not exists("hackaviz-2025/data"):
-    system("git submodule update --init --recursive")
+from scripts.prepare_data import (
+    PREPARED_LOCATION,
+    RAIN_FILENAME,
+    WATER_FILENAME,
+    is_prepared,
+    prepare_datasets,
+)
 
+# Number of points drawn on the water height plot, about its width in pixels
+MAX_PLOT_POINTS = 1500
 
-@st.cache_data
-def load_datasets() -> tuple[pd.DataFrame, pd.DataFrame]:
-    """Load the datasets for water levels and rainfall."""
-    datasets_location = "hackaviz-2025/data"
-    df_water = pd.read_parquet(join(datasets_location, "hauteur_eau_quotidienne_toulouse.parquet"))
-    df_rain = pd.read_parquet(join(datasets_location, "pluviometrie.parquet"))
 
-    df_water["date"] = pd.to_datetime(df_water["date_observation"])
-    df_rain["date"] = pd.to_datetime(df_rain["date_observation"])
+@st.cache_resource
+def load_datasets() -> tuple[dict[pd.Timedelta, pd.DataFrame], pd.DataFrame, pd.DataFrame]:
+    """Load the datasets for water levels and rainfall, and the rainfall stations locations.
 
-    # Clean columns name
-    df_water.rename(columns={"max(hauteur, na.rm = TRUE)": "water_height"}, inplace=True)
-    # Filter impossible data
-    df_water = df_water[df_water["water_height"] < 10000]
-    return df_water, df_rain
+    Water levels are aggregated with the median per day and per week, keyed by bin width from the
+    finest to the coarsest, each bin being dated at its start. The returned frames are shared
+    between all sessions without being copied: they must be treated as read-only.
+    """
+    water_path = join(PREPARED_LOCATION, WATER_FILENAME)
+    rain_path = join(PREPARED_LOCATION, RAIN_FILENAME)
+    if not is_prepared():
+        prepare_datasets()
+
+    # Prepared files are already typed, cleaned and sorted by date
+    df_water = pq.read_table(water_path, use_threads=True).to_pandas(
+        split_blocks=True, self_destruct=True
+    )
+    df_rain = pq.read_table(rain_path, read_dictionary=["nom_usuel"], use_threads=True).to_pandas(
+        split_blocks=True, self_destruct=True
+    )
+
+    # Aggregate water data once, the weekly resolution is used for ranges longer than a few decades
+    water_daily = df_water.groupby("date", sort=True, observed=True)["water_height"].median()
+    # Weekly bins start from the first observation, so that no bin is dated before the data
+    water_levels = {
+        pd.Timedelta(days=1): water_daily.reset_index(),
+        pd.Timedelta(weeks=1): water_daily.resample("7D").median().dropna().reset_index(),
+    }
+
+    # Stations are grouped by name only, their coordinates are kept in a small lookup table
+    df_stations = df_rain.drop_duplicates("nom_usuel")[["nom_usuel", "latitude", "longitude"]]
+    return water_levels, df_rain, df_stations
+
+
+def slice_by_date(df: pd.DataFrame, start_ns: int, end_ns: int) -> pd.DataFrame:
+    """Select the rows of `df` between two nanosecond timestamps (both included).
+
+    `df` must be sorted by its "date" column: the bounds are found by binary search.
+    """
+    dates = df["date"].to_numpy()
+    lo = np.searchsorted(dates, np.datetime64(start_ns, "ns"), side="left")
+    hi = np.searchsorted(dates, np.datetime64(end_ns, "ns"), side="right")
+    return df.iloc[lo:hi]
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Select `n_out` points of the (x, y) series with Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept, and in each bucket the point forming the largest
+    triangle with the previously selected point and the mean of the next bucket is kept, which
+    preserves the peaks of the series.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    # n_out - 2 buckets shared between the points strictly inside the series
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+
+    selected = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_start, next_stop = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        next_x, next_y = x[next_start:next_stop].mean(), y[next_start:next_stop].mean()
+        areas = np.abs(
+            (x[selected] - next_x) * (y[start:stop] - y[selected])
+            - (x[selected] - x[start:stop]) * (next_y - y[selected])
+        )
+        selected = start + int(areas.argmax())
+        indices[i + 1] = selected
+    return indices
+
+
+def compute_water_agg(
+    water_levels: dict[pd.Timedelta, pd.DataFrame], start_ns: int, end_ns: int, max_points: int
+) -> tuple[pd.DataFrame, np.ndarray]:
+    """Select the water heights on a date range and compute their acceleration.
+
+    The finest resolution of `water_levels` having at most `max_points` points on the date range is
+    used. The acceleration normalized to [-1, 1] for the colorscale is returned as a separate array.
+    """
+    for bin_width, df_water in water_levels.items():
+        # Bins are dated at their start, the bin holding start_ns is dated up to one width before
+        df_water_filtered = slice_by_date(df_water, start_ns - bin_width.value + 1, end_ns)
+        if len(df_water_filtered) <= max_points:
+            break
+
+    height = df_water_filtered["water_height"].to_numpy(dtype=np.float64)
+    time_ns = df_water_filtered["date"].to_numpy().astype("datetime64[ns]").view(np.int64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # First derivative (rate of change)
+        delta_height = np.diff(height, prepend=height[:1])
+        delta_time = np.diff(time_ns, prepend=time_ns[:1]) / 1e9
+        velocity = delta_height / delta_time
+        # Second derivative (acceleration)
+        acceleration = np.diff(velocity, prepend=velocity[:1]) / delta_time
+
+    # Handle NaN values resulting from differentiation, on the first two points of the acceleration
+    np.nan_to_num(acceleration, copy=False, nan=0.0)
+
+    # Normalize acceleration for colorscale mapping, scaled to [-1, 1]
+    max_accel = np.abs(acceleration).max(initial=0.0)
+    normalized_acceleration = np.divide(
+        acceleration, max_accel, out=np.zeros_like(acceleration), where=max_accel > 0
+    )
+    return df_water_filtered, normalized_acceleration
+
+
+def compute_rain_agg(
+    df_rain: pd.DataFrame, df_stations: pd.DataFrame, start_ns: int, end_ns: int, top_n: int
+) -> pd.DataFrame:
+    """Aggregate rainfall per station on a date range and keep the `top_n` rainiest ones."""
+    # Filter rain data by selected date range
+    df_rain_filtered = slice_by_date(df_rain, start_ns, end_ns)
+
+    # Aggregate rainfall by location, sum and std are computed in a single groupby pass
+    agg_rain = df_rain_filtered.groupby("nom_usuel", as_index=False, sort=False, observed=True)[
+        "precipitation"
+    ].agg(precipitation_sum="sum", precipitation_std="std")
+
+    # Keep the top_n rainiest stations, only those are sorted
+    sums = agg_rain["precipitation_sum"].to_numpy()
+    k = min(top_n, sums.size)
+    top_idx = np.argpartition(sums, sums.size - k)[sums.size - k :]
+    top_idx = top_idx[np.argsort(-sums[top_idx], kind="stable")]
+    agg_rain = agg_rain.iloc[top_idx].merge(df_stations, on="nom_usuel", how="left")
+
+    # Handle NaN values in standard deviation (for stations with only one measurement)
+    agg_rain["precipitation_std"] = np.nan_to_num(agg_rain["precipitation_std"].to_numpy(), nan=0.0)
+
+    # Normalize variation for color mapping
+    max_variation = agg_rain["precipitation_std"].max()
+    if max_variation > 0:
+        agg_rain["variation_norm"] = agg_rain["precipitation_std"] / max_variation
+    else:
+        agg_rain["variation_norm"] = 0
+    return agg_rain
+
+
+# Cached figures are keyed on int64 nanosecond date ranges, the shared datasets are passed as
+# underscore arguments which Streamlit does not hash.
+@st.cache_resource(max_entries=64, show_spinner=False)
+def build_water_fig(
+    _water_levels: dict[pd.Timedelta, pd.DataFrame], start_ns: int, end_ns: int
+) -> go.Figure:
+    """Build the water height plot colored by acceleration on a date range."""
+    # Coarser resolutions are only used past several times the plot width, so that LTTB selects
+    # the plotted points from a finer series and keeps its peaks
+    df_water_filtered, normalized_acceleration = compute_water_agg(
+        _water_levels, start_ns, end_ns, max_points=8 * MAX_PLOT_POINTS
+    )
+
+    # Downsample the plotted points to the plot width, peaks are kept by LTTB
+    plot_indices = lttb_indices(
+        df_water_filtered["date"].to_numpy().astype(np.int64),
+        df_water_filtered["water_height"].to_numpy(),
+        n_out=MAX_PLOT_POINTS,
+    )
+    df_water_plot = df_water_filtered.iloc[plot_indices]
+
+    custom_colorscale = [
+        [0.0, "#D55E00"],  # Strong deceleration
+        [0.5, "rgba(128,128,128,0.1)"],  # Neutral acceleration (zero)
+        [1.0, "#4B0082"],  # Strong acceleration
+    ]
+
+    # Efficient plotting with a single trace, WebGL traces render the markers on the GPU
+    fig_water = go.Figure(
+        go.Scattergl(
+            x=df_water_plot["date"],
+            y=df_water_plot["water_height"],
+            mode="lines",
+            line=dict(width=4, color="rgba(0,0,0,0.2)"),
+            hoverinfo="skip",
+            showlegend=False,
+        )
+    )
+
+    # Overlay points colored by acceleration
+    fig_water.add_trace(
+        go.Scattergl(
+            x=df_water_plot["date"],
+            y=df_water_plot["water_height"],
+            mode="markers",
+            marker=dict(
+                size=7,
+                color=normalized_acceleration[plot_indices],
+                colorscale=custom_colorscale,
+                cmin=-1,  # Force colorbar to range from -1 to 1
+                cmax=1,
+                colorbar=dict(
+                    title="Acceleration",
+                    tickvals=[-1, 0, 1],
+                    ticktext=["Strongest deceleration", "Usual", "Strongest acceleration"],
+                ),
+                showscale=True,
+            ),
+            showlegend=False,
+            hovertemplate="Date: %{x}<br>Water Height: %{y:.0f} mm<br>Acceleration: %{marker.color:.4f}<extra></extra>",
+        )
+    )
+
+    fig_water.update_layout(
+        title="📈 Water Height Colored by Acceleration",
+        xaxis_title="Date",
+        yaxis_title="Water Height (mm)",
+    )
+
+    fig_water.update_layout(
+        dragmode="select", newselection=dict(line=dict(color="red")), selectdirection="h"
+    )
+
+    fig_water.update_layout(margin=dict(l=0, r=0, t=35, b=0))
+    return fig_water
+
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def build_rain_fig(
+    _df_rain: pd.DataFrame,
+    _df_stations: pd.DataFrame,
+    start_ns: int,
+    end_ns: int,
+    top_n: int,
+    title: str,
+) -> go.Figure | None:
+    """Build the map of the `top_n` rainiest stations on a date range, None if there is no data."""
+    agg_rain = compute_rain_agg(_df_rain, _df_stations, start_ns, end_ns, top_n)
+    if len(agg_rain) == 0:
+        return None
+
+    # Create interactive map, scatter_mapbox is rendered with WebGL and only gets the top N stations
+    fig_rain = px.scatter_mapbox(
+        agg_rain,
+        lat="latitude",
+        lon="longitude",
+        size="precipitation_sum",
+        color="variation_norm",
+        hover_name="nom_usuel",
+        hover_data={
+            "precipitation_sum": ":.2f",
+            "precipitation_std": ":.2f",
+            "latitude": False,
+            "longitude": False,
+            "variation_norm": False,
+        },
+        labels={
+            "precipitation_sum": "Total Precipitation (mm)",
+            "variation_norm": "Variation Level",
+            "precipitation_std": "Standard Deviation",
+        },
+        color_continuous_scale="Turbo",  # High-contrast colormap for variation
+        size_max=25,
+        range_color=[0, 1],
+        zoom=8,
+        mapbox_style="carto-positron",
+        title=title,
+        height=780,
+    )
+
+    fig_rain.update_layout(
+        coloraxis_colorbar=dict(
+            title="Variation Level<br>on Selected period",
+            tickvals=[0, 0.5, 1.0],
+            ticktext=["Lowest", "Medium", "Highest"],
+        )
+    )
+
+    fig_rain.update_layout(margin=dict(l=0, r=0, t=30, b=0))
+    return fig_rain
 
 
 @st.dialog("👋 Welcome to the Toulouse Water & Rainfall Explorer!", width="large")
@@ -83,7 +350,16 @@ st.set_page_config(
 st.title("🌊 Toulouse water levels and rainfall in Occitanie")
 
 # Load datasets
-df_water, df_rain = load_datasets()
+water_levels, df_rain, df_stations = load_datasets()
+
+# Store the bounds of the water observations once, daily water levels are sorted by date
+if "water_date_bounds" not in st.session_state:
+    water_dates = water_levels[pd.Timedelta(days=1)]["date"]
+    st.session_state.water_date_bounds = (
+        water_dates.iloc[0].to_pydatetime(),  # Convert Timestamp to datetime
+        water_dates.iloc[-1].to_pydatetime(),
+    )
+water_date_min, water_date_max = st.session_state.water_date_bounds
 
 # Initialize session state to show popup only at first load
 if "show_tutorial" not in st.session_state:
@@ -100,12 +376,11 @@ with st.sidebar:
 
     date_range = st.slider(
         "📅 Select observation date range:",
-        min_value=df_water["date"].min().to_pydatetime(),  # Convert Timestamp to datetime
-        max_value=df_water["date"].max().to_pydatetime(),
-        value=(datetime(2000, 1, 1), df_water["date"].max().to_pydatetime()),
+        min_value=water_date_min,
+        max_value=water_date_max,
+        value=(datetime(2000, 1, 1), water_date_max),
     )
 
-    aggregation_method = "median"
     n_most_cumulative_precipitations = st.slider(
         "💧 Top N rainfall stations:",
         min_value=1,
@@ -118,178 +393,36 @@ with st.sidebar:
         st.rerun()
 
 
-start_date, end_date = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
-df_water_filtered = df_water[(df_water["date"] >= start_date) & (df_water["date"] <= end_date)]
-
-# Aggregate water data
-df_water_filtered = (
-    df_water_filtered.groupby("date")["water_height"].agg(aggregation_method).reset_index()
-)
-
-# Assuming df_water_agg exists (date, water_height)
-df_water_filtered = df_water_filtered.sort_values("date").reset_index(drop=True)
-
-# Calculate first derivative (rate of change)
-df_water_filtered["delta_height"] = df_water_filtered["water_height"].diff()
-df_water_filtered["delta_time"] = df_water_filtered["date"].diff().dt.total_seconds()
-df_water_filtered["velocity"] = df_water_filtered["delta_height"] / df_water_filtered["delta_time"]
-
-# Calculate second derivative (acceleration)
-df_water_filtered["acceleration"] = (
-    df_water_filtered["velocity"].diff() / df_water_filtered["delta_time"]
-)
-
-# Handle NaN values resulting from differentiation
-df_water_filtered.fillna(0, inplace=True)
-
-# Normalize acceleration for colorscale mapping
-max_accel = df_water_filtered["acceleration"].abs().max()
-df_water_filtered["normalized_acceleration"] = (
-    df_water_filtered["acceleration"] / max_accel
-)  # Scale to [-1, 1]
-
-
-custom_colorscale = [
-    [0.0, "#D55E00"],  # Strong deceleration
-    [0.5, "rgba(128,128,128,0.1)"],  # Neutral acceleration (zero)
-    [1.0, "#4B0082"],  # Strong acceleration
-]
-
-# Efficient plotting with a single trace
-fig_water = go.Figure(
-    go.Scatter(
-        x=df_water_filtered["date"],
-        y=df_water_filtered["water_height"],
-        mode="lines",
-        line=dict(width=4, color="rgba(0,0,0,0.2)"),
-        hoverinfo="skip",
-        showlegend=False,
-    )
-)
-
-# Overlay points colored by acceleration
-fig_water.add_trace(
-    go.Scatter(
-        x=df_water_filtered["date"],
-        y=df_water_filtered["water_height"],
-        mode="markers",
-        marker=dict(
-            size=7,
-            color=df_water_filtered["normalized_acceleration"],
-            colorscale=custom_colorscale,
-            cmin=-1,  # Force colorbar to range from -1 to 1
-            cmax=1,
-            colorbar=dict(
-                title="Acceleration",
-                tickvals=[-1, 0, 1],
-                ticktext=["Strongest deceleration", "Usual", "Strongest acceleration"],
-            ),
-            showscale=True,
-        ),
-        showlegend=False,
-        hovertemplate="Date: %{x}<br>Water Height: %{y:.0f} mm<br>Acceleration: %{marker.color:.4f}<extra></extra>",
-    )
-)
-
-
-fig_water.update_layout(
-    title="📈 Water Height Colored by Acceleration",
-    xaxis_title="Date",
-    yaxis_title="Water Height (mm)",
-)
-
-fig_water.update_layout(
-    dragmode="select", newselection=dict(line=dict(color="red")), selectdirection="h"
+start_date, end_date = np.datetime64(date_range[0], "ns"), np.datetime64(date_range[1], "ns")
+fig_water = build_water_fig(
+    water_levels, start_date.astype(np.int64).item(), end_date.astype(np.int64).item()
 )
 
-fig_water.update_layout(margin=dict(l=0, r=0, t=35, b=0))
-
 event = st.plotly_chart(
     fig_water, use_container_width=True, key="date", theme="streamlit", on_select="rerun"
 )
 
 if len(event.selection.box) > 0:
-    start_rain = pd.to_datetime(event.selection.box[0]["x"][0])
-    end_rain = pd.to_datetime(event.selection.box[0]["x"][1])
+    start_rain = np.datetime64(event.selection.box[0]["x"][0], "ns")
+    end_rain = np.datetime64(event.selection.box[0]["x"][1], "ns")
     if start_rain > end_rain:
         start_rain, end_rain = end_rain, start_rain
 else:
     start_rain, end_rain = start_date, end_date
 
-# Filter rain data by selected date range
-df_rain_filtered = df_rain[(df_rain["date"] >= start_rain) & (df_rain["date"] <= end_rain)]
-
-# Aggregate rainfall by location
-sum_data = (
-    df_rain_filtered.groupby(["nom_usuel", "latitude", "longitude"], as_index=False)[
-        "precipitation"
-    ]
-    .sum()
-    .nlargest(n_most_cumulative_precipitations, "precipitation")
-)
-std_data = df_rain_filtered.groupby(["nom_usuel", "latitude", "longitude"], as_index=False)[
-    "precipitation"
-].std()
-
-
-# Merge the two datasets to align the indices properly
-agg_rain = sum_data.merge(
-    std_data, on=["nom_usuel", "latitude", "longitude"], how="left", suffixes=("_sum", "_std")
+fig_rain = build_rain_fig(
+    df_rain,
+    df_stations,
+    start_rain.astype(np.int64).item(),
+    end_rain.astype(np.int64).item(),
+    n_most_cumulative_precipitations,
+    title=f"🗺️ Top {n_most_cumulative_precipitations} Rainfall Stations ({np.datetime_as_string(start_date, unit='D')} to {np.datetime_as_string(end_date, unit='D')})",
 )
 
-# Handle NaN values in standard deviation (for stations with only one measurement)
-agg_rain["precipitation_std"].fillna(0, inplace=True)
-
-# Normalize variation for color mapping
-max_variation = agg_rain["precipitation_std"].max()
-if max_variation > 0:
-    agg_rain["variation_norm"] = agg_rain["precipitation_std"] / max_variation
-else:
-    agg_rain["variation_norm"] = 0
-
-
-if len(agg_rain) > 0:
-    # Create interactive map
-    fig_rain = px.scatter_mapbox(
-        agg_rain,
-        lat="latitude",
-        lon="longitude",
-        size="precipitation_sum",
-        color="variation_norm",
-        hover_name="nom_usuel",
-        hover_data={
-            "precipitation_sum": ":.2f",
-            "precipitation_std": ":.2f",
-            "latitude": False,
-            "longitude": False,
-            "variation_norm": False,
-        },
-        labels={
-            "precipitation_sum": "Total Precipitation (mm)",
-            "variation_norm": "Variation Level",
-            "precipitation_std": "Standard Deviation",
-        },
-        color_continuous_scale="Turbo",  # High-contrast colormap for variation
-        size_max=25,
-        range_color=[0, 1],
-        zoom=8,
-        mapbox_style="carto-positron",
-        title=f"🗺️ Top {n_most_cumulative_precipitations} Rainfall Stations ({start_date.date()} to {end_date.date()})",
-        height=780,
-    )
-
-    fig_rain.update_layout(
-        coloraxis_colorbar=dict(
-            title="Variation Level<br>on Selected period",
-            tickvals=[0, 0.5, 1.0],
-            ticktext=["Lowest", "Medium", "Highest"],
-        )
-    )
-
-    fig_rain.update_layout(margin=dict(l=0, r=0, t=30, b=0))
+if fig_rain is not None:
     st.plotly_chart(fig_rain, use_container_width=True, theme="streamlit")
 else:
     st.write(
-        f"**🗺️ Top {n_most_cumulative_precipitations} stations by total rainfall ({start_rain.date()} to {end_rain.date()})**"
+        f"**🗺️ Top {n_most_cumulative_precipitations} stations by total rainfall ({np.datetime_as_string(start_rain, unit='D')} to {np.datetime_as_string(end_rain, unit='D')})**"
     )
     st.warning("No data available for the selected date range.")
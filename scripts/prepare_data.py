@@ -0,0 +1,133 @@
+"""Prepare the Hackaviz 2025 datasets for the Streamlit app.
+
+The raw parquet files are rewritten with typed, cleaned and date-sorted columns, one row group per
+year, so that the app only has to read them. Measures and coordinates are stored as float32, which
+is precise enough for millimeters and degrees and halves their size.
+
+Usage: `uv run python -m scripts.prepare_data`
+"""
+
+from os import makedirs, replace
+from os.path import exists, getmtime, join
+from subprocess import run
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+RAW_LOCATION = "hackaviz-2025/data"
+PREPARED_LOCATION = "data"
+WATER_FILENAME = "hauteur_eau_quotidienne_toulouse.parquet"
+RAIN_FILENAME = "pluviometrie.parquet"
+# Bump when the prepared files change format, existing ones are then rebuilt
+PREPARED_VERSION = "1"
+VERSION_FILENAME = "VERSION"
+
+
+def bootstrap_data(raw_location: str = RAW_LOCATION) -> None:
+    """Fetch the raw Hackaviz 2025 datasets from their git submodule if they are missing."""
+    if not all(exists(join(raw_location, name)) for name in (WATER_FILENAME, RAIN_FILENAME)):
+        run(["git", "submodule", "update", "--init", "--recursive", "hackaviz-2025"], check=True)
+
+
+def is_prepared(
+    raw_location: str = RAW_LOCATION, prepared_location: str = PREPARED_LOCATION
+) -> bool:
+    """Tell if the prepared datasets exist in the current format and are newer than the raw ones."""
+    version_path = join(prepared_location, VERSION_FILENAME)
+    if not exists(version_path):
+        return False
+    with open(version_path) as version_file:
+        if version_file.read().strip() != PREPARED_VERSION:
+            return False
+
+    for name in (WATER_FILENAME, RAIN_FILENAME):
+        raw_path, prepared_path = join(raw_location, name), join(prepared_location, name)
+        if not exists(prepared_path):
+            return False
+        # The raw data may be absent when only the prepared files are deployed
+        if exists(raw_path) and getmtime(raw_path) > getmtime(prepared_path):
+            return False
+    return True
+
+
+def write_by_year(df: pd.DataFrame, path: str, use_dictionary: list[str] | bool = False) -> None:
+    """Write `df`, sorted by its "date" column, with one row group per year."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sorting_columns = [pq.SortingColumn(table.schema.get_field_index("date"))]
+    _, year_starts = np.unique(df["date"].dt.year.to_numpy(), return_index=True)
+    with pq.ParquetWriter(
+        path,
+        table.schema,
+        compression="zstd",
+        use_dictionary=use_dictionary,
+        sorting_columns=sorting_columns,
+    ) as writer:
+        # Each write is flushed as its own row group
+        for start, stop in zip(year_starts, [*year_starts[1:], len(df)]):
+            writer.write_table(table.slice(start, stop - start))
+
+
+def prepare_water(raw_path: str, prepared_path: str) -> None:
+    """Clean the daily water heights in Toulouse and write them to `prepared_path`."""
+    # Filter impossible data while reading, row groups out of range are skipped by their statistics
+    df_water = pq.read_table(
+        raw_path,
+        columns=["date_observation", "max(hauteur, na.rm = TRUE)"],
+        filters=[("max(hauteur, na.rm = TRUE)", "<", 10000)],
+        use_threads=True,
+    ).to_pandas()
+
+    df_water = pd.DataFrame(
+        {
+            "date": pd.to_datetime(df_water["date_observation"]).astype("datetime64[ns]"),
+            "water_height": df_water["max(hauteur, na.rm = TRUE)"].astype("float32"),
+        }
+    )
+    df_water = df_water.sort_values("date", kind="stable")
+    write_by_year(df_water, prepared_path)
+
+
+def prepare_rain(raw_path: str, prepared_path: str) -> None:
+    """Clean the rainfall observations of Occitanie and write them to `prepared_path`."""
+    df_rain = pq.read_table(
+        raw_path,
+        columns=["date_observation", "nom_usuel", "latitude", "longitude", "precipitation"],
+        use_threads=True,
+    ).to_pandas()
+
+    df_rain = pd.DataFrame(
+        {
+            "date": pd.to_datetime(df_rain["date_observation"]).astype("datetime64[ns]"),
+            "nom_usuel": df_rain["nom_usuel"].astype("category"),
+            "latitude": df_rain["latitude"].astype("float32"),
+            "longitude": df_rain["longitude"].astype("float32"),
+            "precipitation": df_rain["precipitation"].astype("float32"),
+        }
+    )
+    df_rain = df_rain.sort_values("date", kind="stable")
+    write_by_year(df_rain, prepared_path, use_dictionary=["nom_usuel"])
+
+
+def prepare_datasets(
+    raw_location: str = RAW_LOCATION, prepared_location: str = PREPARED_LOCATION
+) -> None:
+    """Prepare the water levels and rainfall datasets, fetching the raw ones first if needed."""
+    bootstrap_data(raw_location)
+    makedirs(prepared_location, exist_ok=True)
+    water_path = join(prepared_location, WATER_FILENAME)
+    rain_path = join(prepared_location, RAIN_FILENAME)
+
+    # Both files are written aside and moved in place once complete, so that an interrupted run
+    # never leaves a truncated file that would be taken as prepared
+    prepare_water(join(raw_location, WATER_FILENAME), f"{water_path}.tmp")
+    prepare_rain(join(raw_location, RAIN_FILENAME), f"{rain_path}.tmp")
+    replace(f"{water_path}.tmp", water_path)
+    replace(f"{rain_path}.tmp", rain_path)
+    with open(join(prepared_location, VERSION_FILENAME), "w") as version_file:
+        version_file.write(PREPARED_VERSION)
+
+
+if __name__ == "__main__":
+    prepare_datasets()